@@ -0,0 +1,230 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+from urllib.parse import unquote, urlsplit
+
+import gspread
+import requests
+
+import sav_shifts
+import sav_shifts_gsheets
+
+SHEETS_API_URL = "https://sheets.googleapis.com"
+
+
+class FakeSheets:
+    """One in-memory spreadsheet behind the handful of Sheets API calls
+    sav_shifts_gsheets.write_table makes, logging each request's kind and
+    body size.
+
+    Like the real API, writing values outside a tab's grid is an error.
+    """
+
+    def __init__(self, tab_titles=("Setup",)):
+        # Tab properties in tab order, as in the spreadsheets.get response
+        self.sheets = [
+            {
+                "sheetId": sheet_id,
+                "title": title,
+                "index": sheet_id,
+                "gridProperties": {"rowCount": 1000, "columnCount": 26},
+            }
+            for sheet_id, title in enumerate(tab_titles)
+        ]
+        self.next_sheet_id = len(self.sheets)
+        # [(request kind, body bytes, number of value rows)]
+        self.log = []
+        self.lock = threading.Lock()
+
+    def handle(self, method, path, body):
+        """Run one API call. Return (HTTP status, response body)."""
+        split = urlsplit(path)
+        match = re.fullmatch(r"/v4/spreadsheets/([^/:]+)(.*)", split.path)
+        if match is None:
+            return 404, _error(404, f"No such path {path}")
+        spreadsheet_id, rest = match[1], unquote(match[2])
+        with self.lock:
+            if method == "GET" and rest == "":
+                self.log.append(("get", 0, 0))
+                return 200, {
+                    "spreadsheetId": spreadsheet_id,
+                    "properties": {"title": "Fake"},
+                    "sheets": [{"properties": dict(sheet)} for sheet in self.sheets],
+                }
+            if not body:
+                return 400, _error(400, f"No request body for {method} {path}")
+            data = json.loads(body)
+            if method == "POST" and rest == ":batchUpdate":
+                self.log.append(("batchUpdate", len(body), 0))
+                return self._batch_update(spreadsheet_id, data["requests"])
+            if method == "POST" and rest == "/values:batchUpdate":
+                num_rows = sum(
+                    len(value_range["values"]) for value_range in data["data"]
+                )
+                self.log.append(("values.batchUpdate", len(body), num_rows))
+                return self._values_batch_update(spreadsheet_id, data["data"])
+        return 405, _error(405, f"No {method} {path}")
+
+    def _sheet(self, sheet_id=None, title=None):
+        for sheet in self.sheets:
+            if sheet["sheetId"] == sheet_id or sheet["title"] == title:
+                return sheet
+        raise KeyError(sheet_id if title is None else title)
+
+    def _batch_update(self, spreadsheet_id, requests):
+        replies = []
+        for request in requests:
+            if "addSheet" in request:
+                properties = request["addSheet"]["properties"]
+                sheet = {
+                    "sheetId": self.next_sheet_id,
+                    "title": properties["title"],
+                    "gridProperties": dict(properties.get("gridProperties", {})),
+                }
+                self.next_sheet_id += 1
+                self.sheets.insert(properties.get("index", len(self.sheets)), sheet)
+                for index, other_sheet in enumerate(self.sheets):
+                    other_sheet["index"] = index
+                replies.append({"addSheet": {"properties": sheet}})
+            elif "updateSheetProperties" in request:
+                properties = request["updateSheetProperties"]["properties"]
+                sheet = self._sheet(sheet_id=properties["sheetId"])
+                sheet["gridProperties"].update(properties.get("gridProperties", {}))
+                replies.append({})
+            elif "updateCells" in request:
+                replies.append({})
+            else:
+                return 400, _error(400, f"Unsupported request {list(request)}")
+        return 200, {"spreadsheetId": spreadsheet_id, "replies": replies}
+
+    def _values_batch_update(self, spreadsheet_id, data):
+        for value_range in data:
+            title, _, top_left = value_range["range"].rpartition("!")
+            title = title[1:-1].replace("''", "'")
+            first_row = int(re.search(r"\d+", top_left)[0])
+            grid = self._sheet(title=title)["gridProperties"]
+            last_row = first_row + len(value_range["values"]) - 1
+            num_columns = max((len(row) for row in value_range["values"]), default=0)
+            if last_row > grid["rowCount"] or num_columns > grid["columnCount"]:
+                return 400, _error(400, f"Range {value_range['range']} exceeds grid")
+        return 200, {"spreadsheetId": spreadsheet_id, "totalUpdatedRows": 0}
+
+
+def _error(code, message):
+    return {"error": {"code": code, "message": message, "status": "INVALID_ARGUMENT"}}
+
+
+def make_handler(sheets):
+    class Handler(BaseHTTPRequestHandler):
+        def _handle(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            status, result = sheets.handle(self.command, self.path, body)
+            response = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        do_GET = do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class RedirectSession(requests.Session):
+    """Send what gspread means for the Sheets API to base_url instead."""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(SHEETS_API_URL):
+            url = self.base_url + url[len(SHEETS_API_URL) :]
+        return super().request(method, url, *args, **kwargs)
+
+
+def sample_people(num_people):
+    return [
+        sav_shifts.PersonSchedule(
+            f"Person{i} Last{i}",
+            "+15105550000",
+            f"p{i}@example.com",
+            [("Monday, 4/18", "9:30AM - 10:30AM", f"Turf {i}", "HQ 2")] * 3,
+            [("Tuesday, 4/19", "5PM - 6PM")],
+        )
+        for i in range(num_people)
+    ]
+
+
+def oversized_chunks(sheets, max_bytes):
+    """Return the values.batchUpdate requests that were over max_bytes
+    despite holding more than one row.
+    """
+    return [
+        (body_bytes, num_rows)
+        for kind, body_bytes, num_rows in sheets.log
+        if kind == "values.batchUpdate" and body_bytes > max_bytes and num_rows > 1
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Benchmark writing mail merge tabs with
+sav_shifts_gsheets.write_schedule against a local fake Sheets API server.
+
+For each roster size, writes a new tab and then over an existing one,
+printing the number of API requests (including the metadata reads) and the
+bytes of request bodies sent. Exits with an error if a write fails or any
+values.batchUpdate request holding more than one row is bigger than
+--max-request-bytes.
+"""
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=[200, 5000, 50000])
+    parser.add_argument(
+        "--max-request-bytes",
+        type=int,
+        default=sav_shifts_gsheets.MAX_REQUEST_BYTES,
+        help="Passed on as sav_shifts_gsheets.MAX_REQUEST_BYTES",
+    )
+    args = parser.parse_args()
+    sav_shifts_gsheets.MAX_REQUEST_BYTES = args.max_request_bytes
+    failed = False
+    for num_rows in args.rows:
+        for existing in (False, True):
+            sheets = FakeSheets(("Setup", "Out") if existing else ("Setup",))
+            server = ThreadingHTTPServer(("localhost", 0), make_handler(sheets))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            client = gspread.Client(
+                None, RedirectSession(f"http://localhost:{server.server_port}")
+            )
+            sav_shifts_gsheets.open_spreadsheet = client.open_by_url
+            location = sav_shifts_gsheets.SpreadsheetLocation(
+                "https://docs.google.com/spreadsheets/d/fake/edit", "Out"
+            )
+            try:
+                sav_shifts_gsheets.write_schedule(location, sample_people(num_rows))
+                result = "ok"
+            except gspread.exceptions.APIError as e:
+                result = f"FAILED ({e})"
+                failed = True
+            finally:
+                server.shutdown()
+                server.server_close()
+            oversized = oversized_chunks(sheets, args.max_request_bytes)
+            if oversized:
+                result += f", OVERSIZED CHUNKS (bytes, rows): {oversized}"
+                failed = True
+            print(
+                f"rows={num_rows:<6} existing tab={existing!s:<5} "
+                f"requests={len(sheets.log):<3} "
+                f"payload bytes={sum(entry[1] for entry in sheets.log):<9} {result}"
+            )
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,184 @@
+import argparse
+from email.parser import BytesParser
+from email.policy import HTTP
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+import threading
+from urllib.parse import parse_qs, unquote, urlsplit
+import uuid
+
+# The real API accepts at most 50 calls per batch request
+MAX_BATCH_SIZE = 50
+
+
+class FakeCalendar:
+    """In-memory events for the handful of Calendar API calls sav_calendar.py
+    makes, with counts of the calls, so you can check that re-runs only write
+    what changed.
+
+    Like the real API, deleted events are kept as "cancelled" (and listed
+    with showDeleted), and inserting an existing ID is a 409 Conflict.
+    """
+
+    def __init__(self, page_size=2500):
+        self.page_size = page_size
+        # {calendar ID: {event ID: event}}
+        self.calendars = {}
+        self.counts = {"list": 0, "insert": 0, "update": 0, "delete": 0, "batch": 0}
+        self.lock = threading.Lock()
+
+    def handle(self, method, path, body):
+        """Run one API call. Return (HTTP status, response body or None)."""
+        split = urlsplit(path)
+        query = {k: v[0] for k, v in parse_qs(split.query).items()}
+        match = re.fullmatch(r"/calendars/([^/]+)/events(?:/([^/]+))?", split.path)
+        if match is None:
+            return 404, {"error": {"code": 404, "message": f"No such path {path}"}}
+        events = self.calendars.setdefault(unquote(match[1]), {})
+        event_id = match[2] and unquote(match[2])
+        with self.lock:
+            if method == "GET" and event_id is None:
+                self.counts["list"] += 1
+                return 200, self._list(events, query)
+            if method == "POST" and event_id is None:
+                self.counts["insert"] += 1
+                if body["id"] in events:
+                    return 409, {"error": {"code": 409, "message": "Duplicate"}}
+                events[body["id"]] = body
+                return 200, body
+            if method == "PUT" and event_id is not None:
+                self.counts["update"] += 1
+                if event_id not in events:
+                    return 404, {"error": {"code": 404, "message": "Not Found"}}
+                events[event_id] = dict(body, id=event_id)
+                return 200, events[event_id]
+            if method == "DELETE" and event_id is not None:
+                self.counts["delete"] += 1
+                event = events.get(event_id)
+                if event is None or event.get("status") == "cancelled":
+                    return 410, {"error": {"code": 410, "message": "Deleted"}}
+                event["status"] = "cancelled"
+                return 204, None
+        return 405, {"error": {"code": 405, "message": f"No {method} {path}"}}
+
+    def _list(self, events, query):
+        items = list(events.values())
+        if query.get("showDeleted") != "true":
+            items = [item for item in items if item.get("status") != "cancelled"]
+        if "privateExtendedProperty" in query:
+            key, _, value = query["privateExtendedProperty"].partition("=")
+            items = [
+                item
+                for item in items
+                if item.get("extendedProperties", {}).get("private", {}).get(key)
+                == value
+            ]
+        page_size = min(int(query.get("maxResults", 250)), self.page_size)
+        start = int(query.get("pageToken", 0))
+        result = {"items": items[start : start + page_size]}
+        if start + page_size < len(items):
+            result["nextPageToken"] = str(start + page_size)
+        return result
+
+    def handle_batch(self, content_type, body):
+        """Run a multipart/mixed batch request. Return (HTTP status, response
+        content type, response body bytes).
+        """
+        with self.lock:
+            self.counts["batch"] += 1
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        parts = list(message.iter_parts())
+        if len(parts) > MAX_BATCH_SIZE:
+            error = {"error": {"code": 400, "message": "Too many requests in batch"}}
+            return 400, "application/json", json.dumps(error).encode()
+        boundary = "batch_" + uuid.uuid4().hex
+        response = []
+        for part in parts:
+            request_line, _, rest = part.get_payload().partition("\n")
+            method, path, _ = request_line.split(" ", 2)
+            _, _, request_body = rest.replace("\r\n", "\n").partition("\n\n")
+            status, result = self.handle(
+                method, path, json.loads(request_body) if request_body else None
+            )
+            result_body = "" if result is None else json.dumps(result)
+            response.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {status} Fake\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(result_body)}\r\n\r\n"
+                f"{result_body}\r\n"
+            )
+        response.append(f"--{boundary}--\r\n")
+        return 200, f"multipart/mixed; boundary={boundary}", "".join(response).encode()
+
+
+def make_handler(calendar, batch_path="/batch/calendar/v3", on_request=None):
+    """Return a request handler class serving calendar. If on_request is
+    given, it's called with the call counts so far after each HTTP request.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            if self.command == "POST" and self.path == batch_path:
+                self._send(*calendar.handle_batch(self.headers["Content-Type"], body))
+            else:
+                status, result = calendar.handle(
+                    self.command, self.path, json.loads(body) if body else None
+                )
+                self._send(
+                    status,
+                    "application/json",
+                    b"" if result is None else json.dumps(result).encode(),
+                )
+            if on_request is not None:
+                on_request(dict(calendar.counts))
+
+        do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Serve a fake Google Calendar API for testing
+sav_calendar.py without a Google account, e.g.
+
+    python fake_calendar_server.py --port 8080
+    python sav_calendar.py grid.csv primary --api-endpoint http://localhost:8080/
+
+Events are kept in memory until the server is stopped. After each HTTP
+request, prints how many calls of each kind it has handled so far, so
+re-running sav_calendar.py on an unchanged grid should only add a list call.
+"""
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=2500,
+        help="Most events per page of a list call, to test paging",
+    )
+    args = parser.parse_args()
+    calendar = FakeCalendar(args.page_size)
+    server = ThreadingHTTPServer(
+        ("localhost", args.port), make_handler(calendar, on_request=print)
+    )
+    print(f"Fake Calendar API on http://localhost:{args.port}/")
+    server.serve_forever()
@@ -0,0 +1,300 @@
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import os.path
+import re
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from googleapiclient.http import BatchHttpRequest
+import httplib2
+
+import sav_shifts
+
+# If modifying these scopes, delete the file token.json.
+SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+
+# The Calendar API accepts at most 50 calls per batch request
+MAX_BATCH_SIZE = 50
+# Private extended properties marking the events this script manages, and
+# a digest of each event's content so unchanged events can be skipped
+SOURCE_PROPERTY = "sav_shifts"
+DIGEST_PROPERTY = "sav_shifts_digest"
+
+CLOCK_REGEX = r"^\s*(\d{1,2})(?::(\d{2}))?\s*([AaPp][Mm])\s*$"
+
+
+def open_calendar_service(api_endpoint=None):
+    """Build a Calendar API service.
+
+    If api_endpoint is given (e.g. fake_calendar_server.py), connect to
+    it without any credentials; otherwise log in like calendar_quickstart.py.
+    """
+    if api_endpoint is not None:
+        return build(
+            "calendar",
+            "v3",
+            http=httplib2.Http(),
+            client_options={"api_endpoint": api_endpoint},
+            static_discovery=True,
+        )
+    creds = None
+    # The file token.json stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists("token.json"):
+        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+            creds = flow.run_local_server(port=0)
+        with open("token.json", "w") as token:
+            token.write(creds.to_json())
+    return build("calendar", "v3", credentials=creds)
+
+
+def event_id(name, date, time):
+    """Return a stable Calendar event ID for a person's shift.
+
+    Hex digits are all valid in event IDs (which allow base32hex).
+    """
+    key = "\n".join([name.lower(), date, time])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def parse_clock(clock_str):
+    """Convert e.g. "9:30AM" or "5PM" to (hour, minute) on a 24-hour clock."""
+    match = re.match(CLOCK_REGEX, clock_str)
+    if not match:
+        raise ValueError(f"String '{clock_str}' is not a valid time of day")
+    hour = int(match[1]) % 12
+    minute = int(match[2] or 0)
+    if match[3].upper() == "PM":
+        hour += 12
+    return hour, minute
+
+
+def shift_datetimes(date, time, year):
+    """Convert a config-style date ("Monday, 4/18") and time block
+    ("9:30AM - 10:30AM") to start and end datetimes.
+    """
+    month, day = date.split(", ")[-1].split("/")[:2]
+    start_str, end_str = time.split("-")
+    return [
+        datetime(year, int(month), int(day), *parse_clock(clock_str))
+        for clock_str in (start_str, end_str)
+    ]
+
+
+def shift_events(people, year, timezone, include_contacts=False):
+    """Return a dict of event ID to Calendar event body, with one event for
+    each shift of each person.
+
+    Event IDs come from (person, date, time), so a person with more than one
+    shift in the same time block gets one event for the first of them, with
+    a warning. Their phone and email only go in the event description if
+    include_contacts is True.
+    """
+    events = {}
+    for person in people:
+        name, _, _, phone, email = person.contact_list()
+        shifts = [("walkthrough", shift) for shift in person.walkthrough_shifts] + [
+            ("phonebank", shift) for shift in person.phonebank_shifts
+        ]
+        for shift_type, shift in shifts:
+            date, time = shift[0], shift[1]
+            turf, hq = (list(shift[2:4]) + [None, None])[:2]
+            start, end = shift_datetimes(date, time, year)
+            location = turf or ""
+            if hq:
+                location += f" [Report to: {hq}]"
+            body = {
+                "summary": f"{name}: {shift_type}",
+                "location": location.strip(),
+                "start": {"dateTime": start.isoformat(), "timeZone": timezone},
+                "end": {"dateTime": end.isoformat(), "timeZone": timezone},
+                "status": "confirmed",
+            }
+            if include_contacts:
+                body["description"] = "\n".join(x for x in (phone, email) if x)
+            digest = hashlib.sha1(json.dumps(body, sort_keys=True).encode())
+            body["extendedProperties"] = {
+                "private": {SOURCE_PROPERTY: "1", DIGEST_PROPERTY: digest.hexdigest()}
+            }
+            body["id"] = event_id(name, date, time)
+            if body["id"] in events:
+                print(
+                    f"{name} has more than one shift on {date} from {time}, "
+                    f"only publishing the first ({events[body['id']]['summary']})"
+                )
+                continue
+            events[body["id"]] = body
+    return events
+
+
+def list_published_events(service, calendar_id):
+    """Return a dict of event ID to event for every event this script has
+    published to the calendar, including deleted (cancelled) ones.
+    """
+    events = {}
+    page_token = None
+    while True:
+        result = (
+            service.events()
+            .list(
+                calendarId=calendar_id,
+                privateExtendedProperty=f"{SOURCE_PROPERTY}=1",
+                showDeleted=True,
+                maxResults=2500,
+                pageToken=page_token,
+            )
+            .execute()
+        )
+        for event in result.get("items", []):
+            events[event["id"]] = event
+        page_token = result.get("nextPageToken")
+        if page_token is None:
+            return events
+
+
+def plan_changes(desired_events, published_events):
+    """Compare the events that should exist with the ones already published.
+
+    Return lists of event bodies to insert, event bodies to update, and event
+    IDs to delete. Events whose content digest hasn't changed are left alone.
+    """
+    inserts = []
+    updates = []
+    for event_id_, body in desired_events.items():
+        published = published_events.get(event_id_)
+        if published is None:
+            inserts.append(body)
+        elif published.get("status") == "cancelled":
+            # A deleted event keeps its ID, so it can't be inserted again
+            updates.append(body)
+        else:
+            private = published.get("extendedProperties", {}).get("private", {})
+            if private.get(DIGEST_PROPERTY) != (
+                body["extendedProperties"]["private"][DIGEST_PROPERTY]
+            ):
+                updates.append(body)
+    deletes = [
+        event_id_
+        for event_id_, published in published_events.items()
+        if event_id_ not in desired_events and published.get("status") != "cancelled"
+    ]
+    return inserts, updates, deletes
+
+
+def execute_batched(service, requests, batch_uri=None):
+    """Send the API requests in batches of up to MAX_BATCH_SIZE and raise the
+    first error, if any, once they've all been sent.
+    """
+    errors = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
+
+    for start in range(0, len(requests), MAX_BATCH_SIZE):
+        if batch_uri is None:
+            batch = service.new_batch_http_request(callback=callback)
+        else:
+            batch = BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+        for request in requests[start : start + MAX_BATCH_SIZE]:
+            batch.add(request)
+        batch.execute()
+    if errors:
+        raise errors[0]
+
+
+def publish_events(
+    service,
+    calendar_id,
+    people,
+    year,
+    timezone,
+    batch_uri=None,
+    include_contacts=False,
+):
+    """Make the calendar have exactly one event per shift in people (see
+    shift_events).
+
+    Only events that are new, changed or no longer needed are written, so
+    re-running with an unchanged roster sends no writes. Return the number
+    of events inserted, updated and deleted.
+    """
+    desired_events = shift_events(people, year, timezone, include_contacts)
+    published_events = list_published_events(service, calendar_id)
+    inserts, updates, deletes = plan_changes(desired_events, published_events)
+    events = service.events()
+    requests = (
+        [events.insert(calendarId=calendar_id, body=body) for body in inserts]
+        + [
+            events.update(calendarId=calendar_id, eventId=body["id"], body=body)
+            for body in updates
+        ]
+        + [
+            events.delete(calendarId=calendar_id, eventId=event_id_)
+            for event_id_ in deletes
+        ]
+    )
+    execute_batched(service, requests, batch_uri)
+    return len(inserts), len(updates), len(deletes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Publish every shift in the SAV organizing shift signup
+schedule grid as an event on a Google Calendar.
+
+Re-running after the grid changes only adds, changes or removes the events
+for shifts that changed.
+"""
+    )
+    parser.add_argument("infile", help="The signup schedule grid CSV")
+    parser.add_argument(
+        "calendar_id", help='e.g. "primary" or "xyz@group.calendar.google.com"'
+    )
+    parser.add_argument(
+        "--year",
+        type=int,
+        default=datetime.now().year,
+        help="The year the config dates are in (default: this year)",
+    )
+    parser.add_argument("--timezone", default="America/Los_Angeles")
+    parser.add_argument(
+        "--api-endpoint",
+        metavar="URL",
+        help="Talk to this Calendar API server (e.g. fake_calendar_server.py) "
+        "without logging in",
+    )
+    parser.add_argument(
+        "--include-contacts",
+        action="store_true",
+        help="Put each volunteer's phone and email in their events' descriptions; "
+        "anyone who can see the calendar can read them",
+    )
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+    config = sav_shifts.load_config(args.config)
+    people = sav_shifts.load_grid_schedule_csv(args.infile, config)
+    service = open_calendar_service(args.api_endpoint)
+    batch_uri = None
+    if args.api_endpoint is not None:
+        batch_uri = args.api_endpoint.rstrip("/") + "/batch/calendar/v3"
+    inserted, updated, deleted = publish_events(
+        service,
+        args.calendar_id,
+        people,
+        args.year,
+        args.timezone,
+        batch_uri,
+        args.include_contacts,
+    )
+    print(f"Inserted {inserted}, updated {updated}, deleted {deleted} events")
@@ -0,0 +1,278 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from email.message import EmailMessage
+import hashlib
+import json
+import os.path
+import queue
+import re
+import smtplib
+from string import Template
+import threading
+from time import perf_counter
+
+import sav_shifts
+
+DEFAULT_SUBJECT = "Your shifts for $date"
+DEFAULT_TEMPLATE = """Hi $first_name,
+
+Thank you for signing up! Here are your shifts for $date:
+
+$shifts
+
+See you there!
+"""
+
+
+@dataclass
+class ReminderMessage:
+    recipient: str
+    name: str
+    subject: str
+    body: str
+
+
+class ReminderTemplate:
+    """Subject and body templates (string.Template syntax), parsed once and
+    rendered for each person.
+
+    Available placeholders: $full_name, $first_name, $last_name, $phone,
+    $email, $date, $walkthrough_shifts, $phonebank_shifts and $shifts (both
+    kinds, labeled).
+    """
+
+    def __init__(self, body=DEFAULT_TEMPLATE, subject=DEFAULT_SUBJECT):
+        self.body = Template(body)
+        self.subject = Template(subject)
+
+    def render(self, person, date_str):
+        full_name, first_name, last_name, phone, email = person.contact_list()
+        walkthrough_shifts = sav_shifts.MailMergeRow.shifts_to_str(
+            person.walkthrough_shifts
+        )
+        phonebank_shifts = sav_shifts.MailMergeRow.shifts_to_str(
+            person.phonebank_shifts
+        )
+        shifts = []
+        if walkthrough_shifts:
+            shifts.append(f"Walkthrough shifts:\n{walkthrough_shifts}")
+        if phonebank_shifts:
+            shifts.append(f"Phonebank shifts:\n{phonebank_shifts}")
+        values = {
+            "full_name": full_name,
+            "first_name": first_name,
+            "last_name": last_name,
+            "phone": phone or "",
+            "email": email or "",
+            "date": date_str,
+            "walkthrough_shifts": walkthrough_shifts,
+            "phonebank_shifts": phonebank_shifts,
+            "shifts": "\n\n".join(shifts),
+        }
+        return ReminderMessage(
+            email,
+            full_name,
+            self.subject.substitute(values),
+            self.body.substitute(values),
+        )
+
+
+# Sinks' write(message) returns True if the message was written or sent and
+# False if it was skipped
+
+
+class JsonlSink:
+    """Write each message as one line of JSON."""
+
+    def __init__(self, filename):
+        self.outfile = open(filename, "w")
+
+    def write(self, message):
+        self.outfile.write(json.dumps(asdict(message)) + "\n")
+        return True
+
+    def close(self):
+        self.outfile.close()
+
+
+class FileSink:
+    """Write each message to its own text file in directory.
+
+    File names are the person's name plus a short hash of it, so names that
+    reduce to the same characters (e.g. "Ann-Marie Lee" and "Ann Marie Lee")
+    don't overwrite each other.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def write(self, message):
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", message.name).strip("_")
+        name_hash = hashlib.sha1(message.name.encode()).hexdigest()[:8]
+        filename = f"{slug}_{name_hash}.txt"
+        with open(os.path.join(self.directory, filename), "w") as outfile:
+            outfile.write(f"To: {message.recipient or ''}\n")
+            outfile.write(f"Subject: {message.subject}\n\n")
+            outfile.write(message.body)
+        return True
+
+    def close(self):
+        pass
+
+
+class SmtpSink:
+    """Send each message as an email over one SMTP connection.
+
+    People without an email address are skipped.
+    """
+
+    def __init__(self, sender, host="localhost", port=25):
+        self.sender = sender
+        self.connection = smtplib.SMTP(host, port)
+
+    def write(self, message):
+        if not message.recipient:
+            print(f"No email address for {message.name}, skipping")
+            return False
+        email = EmailMessage()
+        email["From"] = self.sender
+        email["To"] = message.recipient
+        email["Subject"] = message.subject
+        email.set_content(message.body)
+        self.connection.send_message(email)
+        return True
+
+    def close(self):
+        self.connection.quit()
+
+
+@dataclass
+class ThroughputReport:
+    messages: int
+    # Messages the sink chose not to send, e.g. for lack of an email address
+    skipped: int
+    seconds: float
+    # Total time renderers spent waiting for room in the queue, i.e. how much
+    # the sink held them back
+    backpressure_seconds: float
+
+    def messages_per_second(self):
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.messages} messages in {self.seconds:.2f}s "
+            f"({self.messages_per_second():.0f}/s), {self.skipped} skipped, "
+            f"renderers waited {self.backpressure_seconds:.2f}s on the sink"
+        )
+
+
+_DONE = object()
+
+
+def send_reminders(people, date_str, template, sink, workers=4, queue_size=1000):
+    """Render a reminder for each person on a pool of worker threads and
+    stream them into sink from a single writer thread.
+
+    At most queue_size rendered messages wait for the sink at once; past that
+    the renderers block until the sink catches up. Return a ThroughputReport.
+    The sink is closed when done.
+    """
+    messages = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+    counts = {"written": 0, "skipped": 0, "backpressure_seconds": 0.0}
+    sink_errors = []
+
+    def drain():
+        while True:
+            message = messages.get()
+            if message is _DONE:
+                return
+            if sink_errors:
+                # Keep emptying the queue so the renderers don't block forever
+                continue
+            try:
+                if sink.write(message):
+                    counts["written"] += 1
+                else:
+                    counts["skipped"] += 1
+            except Exception as e:
+                sink_errors.append(e)
+
+    def render(person):
+        message = template.render(person, date_str)
+        start = perf_counter()
+        messages.put(message)
+        with lock:
+            counts["backpressure_seconds"] += perf_counter() - start
+
+    start = perf_counter()
+    writer = threading.Thread(target=drain)
+    writer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() so that rendering errors are raised here
+            list(pool.map(render, people))
+    finally:
+        messages.put(_DONE)
+        writer.join()
+        sink.close()
+    if sink_errors:
+        raise sink_errors[0]
+    return ThroughputReport(
+        counts["written"],
+        counts["skipped"],
+        perf_counter() - start,
+        counts["backpressure_seconds"],
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Send each volunteer a reminder of their shifts on a given day.
+
+Reads a mail merge CSV made by sav_shifts.py (in any layout), keeps the shifts
+on the given date and renders one message per person with shifts that day.
+The messages go to exactly one of: a JSONL file, a directory of text files,
+or an SMTP server (for testing, e.g. aiosmtpd's debugging server:
+"python -m aiosmtpd -n -l localhost:1025").
+"""
+    )
+    parser.add_argument("infile", help="The mail merge CSV")
+    parser.add_argument("date", help='e.g. "Wednesday, 10/26", matching the config')
+    sink_group = parser.add_mutually_exclusive_group(required=True)
+    sink_group.add_argument("--jsonl", metavar="FILE")
+    sink_group.add_argument("--outdir", metavar="DIRECTORY")
+    sink_group.add_argument("--smtp", metavar="HOST:PORT")
+    parser.add_argument("--sender", help="The From address when using --smtp")
+    parser.add_argument(
+        "--template",
+        metavar="TEXT_FILE",
+        help="Message body template; see ReminderTemplate for placeholders",
+    )
+    parser.add_argument("--subject", default=DEFAULT_SUBJECT)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    args = parser.parse_args()
+    body = DEFAULT_TEMPLATE
+    if args.template is not None:
+        with open(args.template, "r") as template_file:
+            body = template_file.read()
+    template = ReminderTemplate(body, args.subject)
+    if args.jsonl is not None:
+        sink = JsonlSink(args.jsonl)
+    elif args.outdir is not None:
+        sink = FileSink(args.outdir)
+    else:
+        if args.sender is None:
+            parser.error("--sender is required with --smtp")
+        host, _, port = args.smtp.rpartition(":")
+        sink = SmtpSink(args.sender, host, int(port))
+    existing_people = list(sav_shifts.scan_mailmerge_csv(args.infile).values())
+    people = sav_shifts.filter_daily_shifts(args.date, existing_people)
+    report = send_reminders(
+        people, args.date, template, sink, args.workers, args.queue_size
+    )
+    print(report)
@@ -1,9 +1,24 @@
 import argparse
+from collections import Counter
+from contextlib import contextmanager
 import copy
 import csv
 from dataclasses import dataclass, field as dc_field
+from functools import lru_cache
+import hashlib
+import io
 import json
+import os
 import re
+import stat
+import sys
+import tempfile
+from time import perf_counter
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 class SpreadsheetLocationError(Exception):
@@ -34,24 +49,33 @@ class PersonSchedule:
     phonebank_shifts: list = dc_field(default_factory=list)
 
     def to_list(self):
+        return self.contact_list() + [
+            self.shifts_to_str(self.walkthrough_shifts),
+            self.shifts_to_str(self.phonebank_shifts),
+        ]
+
+    def contact_list(self):
         return [
             self.name,
             self.first_name(),
             self.last_name(),
             self.phone,
             self.email,
-            self.shifts_to_str(self.walkthrough_shifts),
-            self.shifts_to_str(self.phonebank_shifts),
         ]
 
     @staticmethod
-    def list_headers():
+    def contact_headers():
         return [
             "Full name",
             "First name",
             "Last name",
             "cell",
             "Recipient",
+        ]
+
+    @staticmethod
+    def list_headers():
+        return PersonSchedule.contact_headers() + [
             "Walkthrough shifts",
             "Phonebank shifts",
         ]
@@ -108,22 +132,32 @@ class MailMergeRow:
     last_name: str
     phone: str
     email: str
+    # None until process_shifts_list parses the raw_ cells below
     walkthrough_shifts: list
     phonebank_shifts: list
     other_columns: dict
+    # The shift cells as read from a mail merge spreadsheet. Update runs
+    # replace or drop nearly every existing row's shifts, so they're only
+    # parsed when needed, and written back out as is if never parsed
+    raw_walkthrough_shifts: str = dc_field(default=None, repr=False, compare=False)
+    raw_phonebank_shifts: str = dc_field(default=None, repr=False, compare=False)
 
     def to_list(self):
-        standard_columns = [
+        standard_columns = self.contact_list() + [
+            self._shifts_cell(self.walkthrough_shifts, self.raw_walkthrough_shifts),
+            self._shifts_cell(self.phonebank_shifts, self.raw_phonebank_shifts),
+        ]
+        additional_columns = list(self.other_columns.values())
+        return standard_columns + additional_columns
+
+    def contact_list(self):
+        return [
             self.full_name,
             self.first_name,
             self.last_name,
             self.phone,
             self.email,
-            self.shifts_to_str(self.walkthrough_shifts),
-            self.shifts_to_str(self.phonebank_shifts),
         ]
-        additional_columns = list(self.other_columns.values())
-        return standard_columns + additional_columns
 
     @staticmethod
     def shifts_to_list(shifts_str):
@@ -167,74 +201,379 @@ class MailMergeRow:
         additional_columns = list(self.other_columns.keys())
         return PersonSchedule.list_headers() + additional_columns
 
+    def _shifts_cell(self, shifts, raw_shifts):
+        if shifts is None:
+            return raw_shifts
+        return self.shifts_to_str(shifts)
+
     def process_shifts_list(self):
-        self.walkthrough_shifts = self.shifts_to_list(self.walkthrough_shifts)
-        self.phonebank_shifts = self.shifts_to_list(self.phonebank_shifts)
+        """Parse the raw shift cells, if that hasn't been done yet."""
+        if self.walkthrough_shifts is None:
+            self.walkthrough_shifts = self.shifts_to_list(self.raw_walkthrough_shifts)
+        if self.phonebank_shifts is None:
+            self.phonebank_shifts = self.shifts_to_list(self.raw_phonebank_shifts)
 
 
-def columns_lookup(config, column_number):
-    if column_number not in config["columns"]:
-        column_number = column_number - 1
-    return config["columns"][column_number]
+@dataclass
+class StaffingRollup:
+    """Running per-slot coverage counts, keyed by
+    (date, time, turf, hq, shift_type).
 
+    Filled in by parse_row while the grid is scanned, so the rollup never
+    needs a second pass over the data.
+    """
 
-def weekday_columns(config):
-    columns = []
-    for column in config["columns"]:
-        columns.append(column)
-        columns.append(column + 2)
-    return columns
+    signups: Counter = dc_field(default_factory=Counter)
+    empty_slots: Counter = dc_field(default_factory=Counter)
+    # Name columns whose open-ended last time block (see
+    # ScheduleLayout.in_open_block) has reached a blank row
+    closed_columns: set = dc_field(default_factory=set)
+
+    def add_signup(self, signup):
+        key = (signup.date, signup.time, signup.turf, signup.hq, signup.shift_type)
+        self.signups[key] += 1
+
+    def add_empty_slot(self, date, time, shift_type, turf, hq):
+        key = (date, time, turf, hq, shift_type)
+        self.empty_slots[key] += 1
+
+    def unassigned_turfs(self, key):
+        # A turf is unassigned if someone wrote it down but none of its
+        # organizer slots has a signup
+        turf = key[2]
+        return int(turf is not None and self.signups[key] == 0)
+
+    def keys(self):
+        # Dates in the same order as the output layouts
+        return sorted(
+            set(self.signups) | set(self.empty_slots),
+            key=lambda key: (_date_sort_key(key[0]),)
+            + tuple("" if part is None else part for part in key),
+        )
 
+    def to_lists(self):
+        return [
+            list(key)
+            + [self.signups[key], self.empty_slots[key], self.unassigned_turfs(key)]
+            for key in self.keys()
+        ]
 
-def weekend_columns(config):
-    columns = []
-    for column in config["weekend_columns"]:
-        columns.append(column)
-        columns.append(column + 2)
-    return columns
+    @staticmethod
+    def list_headers():
+        return [
+            "Date",
+            "Time",
+            "Turf",
+            "HQ",
+            "Shift type",
+            "Signups",
+            "Empty organizer slots",
+            "Unassigned turfs",
+        ]
 
 
-def good_columns(config):
-    return weekday_columns(config) + weekend_columns(config)
+### Output layouts
+# "mailmerge": one row per person, each shift type's shifts joined into one cell
+# "long": one row per (person, shift) with the shift split into typed columns
+# "wide": one row per person with one column per date
+OUTPUT_LAYOUTS = ["mailmerge", "long", "wide"]
+LONG_SHIFT_HEADERS = ["Shift type", "Date", "Time", "Turf", "HQ"]
+WIDE_DATE_PREFIX = "Shifts on "
+# Within a wide date cell, shifts are separated by newlines and each shift's
+# fields (shift type, time, turf, HQ) by WIDE_FIELD_SEPARATOR
+WIDE_FIELD_SEPARATOR = " | "
+
+
+def table_headers(people, layout="mailmerge"):
+    if layout == "mailmerge":
+        if not people:
+            return PersonSchedule.list_headers()
+        return people[0].list_headers()
+    contact_headers = PersonSchedule.contact_headers()
+    other_headers = _other_column_names(people)
+    if layout == "long":
+        return contact_headers + LONG_SHIFT_HEADERS + other_headers
+    if layout == "wide":
+        date_headers = [WIDE_DATE_PREFIX + date for date in _all_dates(people)]
+        return contact_headers + date_headers + other_headers
+    raise ValueError(f"Invalid layout: {layout}")
+
+
+def table_rows(people, layout="mailmerge"):
+    if layout == "mailmerge":
+        return [person.to_list() for person in people]
+    other_headers = _other_column_names(people)
+    rows = []
+    if layout == "long":
+        for person in people:
+            contact = person.contact_list()
+            other_values = _other_values(person, other_headers)
+            shifts = _typed_shifts(person)
+            if not shifts:
+                rows.append(contact + [""] * len(LONG_SHIFT_HEADERS) + other_values)
+            for shift in shifts:
+                rows.append(contact + list(shift) + other_values)
+        return rows
+    if layout == "wide":
+        dates = _all_dates(people)
+        for person in people:
+            cells = {date: [] for date in dates}
+            for shift_type, date, time, turf, hq in _typed_shifts(person):
+                fields = [shift_type, time]
+                if shift_type == "walkthrough":
+                    fields += [turf, hq]
+                for field in fields:
+                    if WIDE_FIELD_SEPARATOR in field or "\n" in field:
+                        raise ValueError(
+                            f"Can't write '{field}' in the wide layout because it "
+                            f"contains '{WIDE_FIELD_SEPARATOR}' or a line break; "
+                            "use the long layout instead"
+                        )
+                cells[date].append(WIDE_FIELD_SEPARATOR.join(fields))
+            rows.append(
+                person.contact_list()
+                + ["\n".join(cells[date]) for date in dates]
+                + _other_values(person, other_headers)
+            )
+        return rows
+    raise ValueError(f"Invalid layout: {layout}")
 
 
-def schedule_lookup(config, row_number, column_number):
-    """Convert from a row and column number to event date, time and shift type.
+def _typed_shifts(person):
+    """Return (shift type, date, time, turf, hq) for each of person's shifts,
+    sorted by date, with "" for any missing turf or HQ.
+    """
+    shifts = [
+        ("walkthrough", shift[0], shift[1], *_turf_hq(shift))
+        for shift in person.walkthrough_shifts
+    ] + [("phonebank", shift[0], shift[1], "", "") for shift in person.phonebank_shifts]
+    return sorted(shifts, key=lambda shift: _date_sort_key(shift[1]))
 
-    row_number and column_number should be 1-based!!!
+
+def _turf_hq(shift):
+    # Walkthrough shifts parsed from mailmerge text have no turf or HQ fields
+    # at all when neither was given
+    if len(shift) > 2:
+        return shift[2] or "", shift[3] or ""
+    return "", ""
+
+
+def _date_sort_key(date):
+    # Matches the ordering of shifts_to_str, which sorts on the part after ", "
+    return date.split(", ")[-1]
+
+
+def _all_dates(people):
+    dates = {shift[1] for person in people for shift in _typed_shifts(person)}
+    return sorted(dates, key=_date_sort_key)
+
+
+def _other_column_names(people):
+    names = []
+    for person in people:
+        for name in getattr(person, "other_columns", {}):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def _other_values(person, other_headers):
+    other_columns = getattr(person, "other_columns", {})
+    return [other_columns.get(name, "") for name in other_headers]
+
+
+@dataclass
+class ShiftSlot:
+    """What someone signing up in a particular name cell is signing up for."""
+
+    date: str
+    time: str
+    shift_type: str
+    turf_column: int
+
+
+class ScheduleLayout:
+    """The layout regions of the signup grid, compiled into a table from
+    each name cell to its ShiftSlot so that looking up a cell takes the same
+    time however many regions there are.
+
+    Each region (e.g. weekdays, weekends, or week 2 below week 1 in the same
+    columns) is a dict with:
+    - "columns": {first organizer column: date}
+    - "rows": {first row of a time block: [time, shift_type], or null for
+      rows to ignore}; each time block runs until the next one starts
+    - "last_row": the region's last row; by default its last time block runs
+      until the next region down in any of the same columns starts, or to
+      the end of the sheet if there isn't one
+    - "slots": organizer name columns per date, 2 columns apart (default 2)
+    - "turf_offset": columns from the first organizer column to the turf/HQ
+      column (default 2 * slots)
+
+    Regions may share columns but not cells.
+
+    Row and column numbers are 1-based!!!
     """
-    if column_number in weekday_columns(config):
-        row_key = "rows"
-        column_key = "columns"
-    elif column_number in weekend_columns(config):
-        row_key = "weekend_rows"
-        column_key = "weekend_columns"
-    else:
-        raise SpreadsheetLocationError(
-            f"Column {column_number} isn't a cell for someone's name"
+
+    def __init__(self, regions):
+        # {region name: (rows, columns, set of name columns)}
+        parsed_regions = {}
+        for region_name, region in regions.items():
+            rows = {int(k): v for k, v in region["rows"].items()}
+            columns = {int(k): v for k, v in region["columns"].items()}
+            if not rows or not columns:
+                continue
+            name_columns = {
+                first_column + 2 * slot_index
+                for first_column in columns
+                for slot_index in range(region.get("slots", 2))
+            }
+            parsed_regions[region_name] = (rows, columns, name_columns)
+        self._name_columns = set().union(
+            *(name_columns for _, _, name_columns in parsed_regions.values())
         )
-    # For columns, could be Organizer 1 or Organizer 2 so have to check
-    if column_number in config[column_key]:
-        date = config[column_key][column_number]
-    elif column_number - 2 in config[column_key]:
-        date = config[column_key][column_number - 2]
-    else:
-        raise SpreadsheetLocationError(
-            f"Column {column_number} isn't conforming to the config!"
+        self.name_columns = sorted(self._name_columns)
+        self.first_row = min(
+            (min(rows) for rows, _, _ in parsed_regions.values()), default=None
         )
+        self._slots = {}
+        # For the bottom region in a column without a last_row, its last time
+        # block, which runs to the end of the sheet: {column: (start row, slot)}
+        self._open_blocks = {}
+        for region_name, (rows, columns, name_columns) in parsed_regions.items():
+            region = regions[region_name]
+            start_rows = sorted(rows)
+            if "last_row" in region:
+                end_row = int(region["last_row"]) + 1
+            else:
+                # Up to the next region down that shares a column, if any
+                end_row = min(
+                    (
+                        min(other_rows)
+                        for other_rows, _, other_columns in parsed_regions.values()
+                        if min(other_rows) > start_rows[0]
+                        and other_columns & name_columns
+                    ),
+                    default=None,
+                )
+            slots_per_date = region.get("slots", 2)
+            turf_offset = region.get("turf_offset", 2 * slots_per_date)
+            for first_column, date in columns.items():
+                turf_column = first_column + turf_offset
+                blocks = [
+                    (
+                        start_row,
+                        next_start_row,
+                        None
+                        if rows[start_row] is None
+                        else ShiftSlot(date, *rows[start_row], turf_column),
+                    )
+                    for start_row, next_start_row in zip(
+                        start_rows, start_rows[1:] + [end_row]
+                    )
+                ]
+                for slot_index in range(slots_per_date):
+                    column = first_column + 2 * slot_index
+                    for start_row, next_start_row, slot in blocks:
+                        if next_start_row is None:
+                            if column in self._open_blocks:
+                                raise SpreadsheetLocationError(
+                                    f"Column {column} from row {start_row} is "
+                                    "in more than one layout region"
+                                )
+                            self._open_blocks[column] = (start_row, slot)
+                            continue
+                        for row in range(start_row, next_start_row):
+                            if (row, column) in self._slots:
+                                raise SpreadsheetLocationError(
+                                    f"Cell at row {row}, column {column} is in "
+                                    f"more than one layout region ({region_name})"
+                                )
+                            self._slots[row, column] = slot
+        for row, column in self._slots:
+            if column in self._open_blocks and row >= self._open_blocks[column][0]:
+                raise SpreadsheetLocationError(
+                    f"Cell at row {row}, column {column} is in more than one "
+                    "layout region"
+                )
 
-    # Look up the shift type and time from the row
-    time_block_defs = config[row_key]
-    last_block = [None, None]
-    for time_block_start_row in sorted(time_block_defs):
-        if time_block_start_row > row_number:
-            if last_block is None:
-                # Then this row should be ignored ...
-                return None, None, None
-            time, shift_type = last_block
-        else:
-            last_block = time_block_defs[time_block_start_row]
-    return date, time, shift_type
+    def in_open_block(self, row_number, column_number):
+        """Whether a name cell is in a last time block that has no last_row
+        and so runs to the end of the sheet.
+        """
+        return (
+            column_number in self._open_blocks
+            and row_number >= self._open_blocks[column_number][0]
+        )
+
+    def lookup(self, row_number, column_number):
+        """Return the ShiftSlot for a name cell, or None if its row should be
+        ignored.
+        """
+        if (row_number, column_number) in self._slots:
+            return self._slots[row_number, column_number]
+        if column_number in self._open_blocks:
+            open_start_row, slot = self._open_blocks[column_number]
+            if row_number >= open_start_row:
+                return slot
+            return None
+        if column_number not in self._name_columns:
+            raise SpreadsheetLocationError(
+                f"Column {column_number} isn't a cell for someone's name"
+            )
+        return None
+
+
+def compile_layout(config):
+    """Compile a config dict (as read from the JSON config file) into a
+    ScheduleLayout. A ScheduleLayout is returned as is.
+
+    The config has a "layouts" dict of named regions (see ScheduleLayout).
+    Older configs with top-level "columns"/"rows" and
+    "weekend_columns"/"weekend_rows" are read as "weekday" and "weekend"
+    regions with the default 2 organizer slots.
+    """
+    if isinstance(config, ScheduleLayout):
+        return config
+    if "layouts" in config:
+        return ScheduleLayout(config["layouts"])
+    return ScheduleLayout(
+        {
+            "weekday": {"columns": config["columns"], "rows": config["rows"]},
+            "weekend": {
+                "columns": config.get("weekend_columns", {}),
+                "rows": config.get("weekend_rows", {}),
+            },
+        }
+    )
+
+
+def _require_layout(config):
+    # Per-cell helpers never compile, since that costs far more than a lookup
+    if not isinstance(config, ScheduleLayout):
+        raise TypeError(
+            "config must be a ScheduleLayout; compile it once with "
+            "compile_layout or load_config"
+        )
+    return config
+
+
+def load_config(filename):
+    with open(filename, "r") as configfile:
+        return compile_layout(json.load(configfile))
+
+
+def schedule_lookup(config, row_number, column_number):
+    """Convert from a row and column number to event date, time and shift type.
+
+    config must be a ScheduleLayout.
+
+    row_number and column_number should be 1-based!!!
+    """
+    slot = _require_layout(config).lookup(row_number, column_number)
+    if slot is None:
+        # Then this row should be ignored ...
+        return None, None, None
+    return slot.date, slot.time, slot.shift_type
 
 def parse_turfHQ(turf_string):
     split = turf_string.split("//")
@@ -258,51 +597,126 @@ def ampm(hour):
 
 ### Regexes
 NAME_REGEX = r"^[^0-9(\n]+[^0-9,?(\n- ]"
-PHONE_REGEX = r"((\(?[0-9]\)?[-.]?){10})"
+# 10 digits, optionally preceded by a +1 or 1 country code
+PHONE_REGEX = r"((\+?1[-.]?)?(\(?[0-9]\)?[-.]?){10})"
 # An @ surrounded by 1 or more letters, numbers, -_.
 EMAIL_REGEX = r"[A-Za-z0-9\-_.]+@[A-Za-z0-9\-_.]+"
+# Emails first, so that digits at the start of an address aren't taken for a phone
+CONTACT_REGEX = re.compile(f"(?P<email>{EMAIL_REGEX})|(?P<phone>{PHONE_REGEX})")
+PHONE_PATTERN = re.compile(PHONE_REGEX)
+NON_DIGIT_PATTERN = re.compile(r"[^0-9]")
+
+# Each person's contact cell is repeated next to every one of their shifts,
+# so only parse each distinct string once
+CONTACT_CACHE_SIZE = 4096
+_contact_parse_stats = {"parses": 0, "parse_seconds": 0.0}
 
 
 def extract_phone_email(content):
-    phone = re.search(PHONE_REGEX, content)
-    if phone:
-        phone = phone.group(0)
-        phone = "".join([s for s in phone if s in "0123456789"])
-    email = re.search(EMAIL_REGEX, content)
-    if email:
-        email = email.group(0)
+    """Return the first phone number (in E.164 format) and the first email
+    address (lowercased) in content, or None for either that isn't there.
+
+    Results are memoized by content; see contact_scan_stats.
+    """
+    return _scan_contact(content)
+
+
+@lru_cache(maxsize=CONTACT_CACHE_SIZE)
+def _scan_contact(content):
+    start = perf_counter()
+    phone = None
+    email = None
+    for match in CONTACT_REGEX.finditer(content):
+        if match.lastgroup == "email":
+            if email is None:
+                email = match.group("email").lower()
+        elif phone is None:
+            phone = normalize_phone(match.group("phone"))
+        if phone is not None and email is not None:
+            break
+    if phone is None and email is not None:
+        # Last resort: a number that's only written as part of the email,
+        # e.g. 5105551234@vtext.com
+        phone_in_email = PHONE_PATTERN.search(email)
+        if phone_in_email:
+            phone = normalize_phone(phone_in_email.group(0))
+    _contact_parse_stats["parses"] += 1
+    _contact_parse_stats["parse_seconds"] += perf_counter() - start
     return phone, email
 
 
-def scan_csv(filename, config):
+def normalize_phone(phone):
+    """Convert a US phone number matched by PHONE_REGEX to E.164."""
+    digits = NON_DIGIT_PATTERN.sub("", phone)
+    if len(digits) == 11:
+        # Drop the country code; it's always 1 here
+        digits = digits[1:]
+    return "+1" + digits
+
+
+def contact_scan_stats():
+    """Return how many contact strings extract_phone_email was asked for,
+    how many it actually had to parse, and the total time spent parsing.
+    """
+    cache_info = _scan_contact.cache_info()
+    return {
+        "lookups": cache_info.hits + cache_info.misses,
+        "parses": _contact_parse_stats["parses"],
+        "cache_hits": cache_info.hits,
+        "parse_seconds": _contact_parse_stats["parse_seconds"],
+    }
+
+
+def scan_csv(filename, config, rollup=None):
+    layout = compile_layout(config)
     signups = []
     with open(filename, "r") as infile:
         csv_reader = csv.reader(infile)
         for row_index, row in enumerate(csv_reader):
-            new_signups = parse_row(row, row_index, config)
+            new_signups = parse_row(row, row_index, layout, rollup)
             if new_signups is not None:
                 signups.extend(new_signups)
     return signups
 
-def parse_row(row, row_index, config):
+def parse_row(row, row_index, config, rollup=None):
     """Return a list of SignupCells from that row.
 
+    If rollup is a StaffingRollup, also count every signup and empty slot
+    in the row into it. A time block without a set end stops counting empty
+    slots at its first blank row, so blank rows and notes below the grid
+    don't count. config must be a ScheduleLayout.
+
     row_index is 0-based!
     """
+    layout = _require_layout(config)
     signups = []
     row_number = row_index + 1
-    if row_number < min(config["rows"].keys()):
+    if layout.first_row is None or row_number < layout.first_row:
         return
-    for column_number in good_columns(config):
+    row_is_blank = not any(cell.strip() for cell in row)
+    for column_number in layout.name_columns:
+        slot = layout.lookup(row_number, column_number)
+        if slot is None:
+            continue
         column_index = column_number - 1
         name = row[column_index]
         email_phone_string = row[column_index + 1]
-        turf_string = row[column_index + 4 if column_number+2 in good_columns(config) else column_index + 2]
-        signup = parse_cell(
-            name, email_phone_string, turf_string, row_index, column_index, config
+        turf_string = row[slot.turf_column - 1]
+        signup = _signup_cell(
+            name, email_phone_string, turf_string, row_number, column_number, slot
         )
         if signup is not None:
             signups.append(signup)
+        if rollup is not None:
+            if signup is not None:
+                rollup.add_signup(signup)
+            elif layout.in_open_block(row_number, column_number) and (
+                row_is_blank or column_number in rollup.closed_columns
+            ):
+                rollup.closed_columns.add(column_number)
+            else:
+                turf, hq = parse_turfHQ(turf_string)
+                rollup.add_empty_slot(slot.date, slot.time, slot.shift_type, turf, hq)
     return signups
 
 
@@ -310,29 +724,40 @@ def parse_cell(name, email_phone_string, turf_string, row_index, column_index, c
     """Create a SignupCell object based on the content and row/column
     of a spreadsheet cell.
 
+    config must be a ScheduleLayout.
+
     row_index and column_index should be 0-based!!!
     """
+    row_number = row_index + 1
+    column_number = column_index + 1
+    slot = _require_layout(config).lookup(row_number, column_number)
+    if slot is None:
+        return
+    return _signup_cell(
+        name, email_phone_string, turf_string, row_number, column_number, slot
+    )
+
+
+def _signup_cell(
+    name, email_phone_string, turf_string, row_number, column_number, slot
+):
     if len(name) <= 5:
         return
-    column_number = column_index + 1
-    row_number = row_index + 1
     phone, email = extract_phone_email(email_phone_string)
-    date, time, shift_type = schedule_lookup(config, row_number, column_number)
     turf, hq = parse_turfHQ(turf_string)
-    if time is not None:
-        return SignupCell(
-            [name, email_phone_string],
-            row_number,
-            column_number,
-            date,
-            time,
-            shift_type,
-            name,
-            phone,
-            email,
-            turf,
-            hq,
-        )
+    return SignupCell(
+        [name, email_phone_string],
+        row_number,
+        column_number,
+        slot.date,
+        slot.time,
+        slot.shift_type,
+        name,
+        phone,
+        email,
+        turf,
+        hq,
+    )
 
 
 def aggregate_signups(signups):
@@ -367,57 +792,271 @@ def aggregate_signups(signups):
     return list(people.values())
 
 
-def write_csv(filename, people):
-    first_person = people[0]
-    with open(filename, "w") as outfile:
-        csv_writer = csv.writer(outfile)
-        csv_writer.writerow(first_person.list_headers())
-        for person in people:
-            csv_writer.writerow(person.to_list())
+def write_csv(filename, people, layout="mailmerge"):
+    with output_lock(filename):
+        write_csv_rows(
+            filename, [table_headers(people, layout)] + table_rows(people, layout)
+        )
+
+
+def write_rollup_csv(filename, rollup):
+    with output_lock(filename):
+        write_csv_rows(filename, [rollup.list_headers()] + rollup.to_lists())
+
+
+# {lock file name: [descriptor, depth]} for the output locks this process holds
+_held_output_locks = {}
+
 
+@contextmanager
+def output_lock(*filenames):
+    """Hold an exclusive advisory lock for each of filenames, so that
+    overlapping runs reading and writing the same files take turns instead
+    of interleaving.
 
-def load_grid_schedule_csv(filename, config):
-    signup_cells = scan_csv(filename, config)
+    The files themselves can't be locked, since writing replaces them by
+    renaming, so each one gets a lock file named after its real path in a
+    sav_shifts-locks directory under the temp directory. That keeps lock
+    files out of the output directory.
+
+    Reentrant within a process, so write_csv can be called while holding a
+    lock on its file. Does nothing where fcntl isn't available.
+    """
+    if fcntl is None:
+        yield
+        return
+    # Always in the same order, so two runs can't each hold one and wait on
+    # the other
+    lock_filenames = sorted({_lock_filename(filename) for filename in filenames})
+    acquired = []
+    try:
+        for lock_filename in lock_filenames:
+            if lock_filename not in _held_output_locks:
+                lock_fd = os.open(lock_filename, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(lock_fd)
+                    raise
+                _held_output_locks[lock_filename] = [lock_fd, 0]
+            _held_output_locks[lock_filename][1] += 1
+            acquired.append(lock_filename)
+        yield
+    finally:
+        for lock_filename in reversed(acquired):
+            held = _held_output_locks[lock_filename]
+            held[1] -= 1
+            if held[1] == 0:
+                # Closing the descriptor releases the lock
+                del _held_output_locks[lock_filename]
+                os.close(held[0])
+
+
+def _lock_filename(filename):
+    lock_directory = os.path.join(tempfile.gettempdir(), "sav_shifts-locks")
+    os.makedirs(lock_directory, exist_ok=True)
+    path_hash = hashlib.sha1(os.path.realpath(filename).encode()).hexdigest()
+    return os.path.join(lock_directory, path_hash + ".lock")
+
+
+def write_csv_rows(filename, rows):
+    """Replace filename with rows (lists of strings) as CSV, atomically.
+
+    The whole file is formatted in memory, written to a temporary file next
+    to filename in one write, fsynced and then renamed over filename, so
+    readers see either the old file or the new one, never part of one.
+
+    If filename is a symlink, the file it points to is replaced instead, and
+    an existing file keeps its permissions.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    filename = os.path.realpath(filename)
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(temp_filename, "w", newline="") as outfile:
+            if os.path.exists(filename):
+                # e.g. a 0600 file of volunteers' contact info stays 0600
+                os.chmod(outfile.fileno(), stat.S_IMODE(os.stat(filename).st_mode))
+            outfile.write(buffer.getvalue())
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    _fsync_directory(os.path.dirname(filename))
+
+
+def _fsync_directory(directory):
+    # Makes a rename in directory durable. Directories can't be opened on
+    # Windows, where there's no O_DIRECTORY
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    directory_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def load_grid_schedule_csv(filename, config, rollup=None):
+    signup_cells = scan_csv(filename, config, rollup)
     people = aggregate_signups(signup_cells)
     return sorted(people)
 
 
 def scan_mailmerge_csv(filename):
-    people = {}
-    num_standard_columns = len(PersonSchedule.list_headers())
     with open(filename, "r") as infile:
-        csv_reader = csv.reader(infile)
-        for i, row in enumerate(csv_reader):
-            if i == 0:
-                header = row
-                additional_columns = row[num_standard_columns:]
-                continue
+        return parse_mailmerge_table(csv.reader(infile))
+
+
+def parse_mailmerge_table(rows):
+    """Parse the rows (lists of strings, header first) of an output-formatted
+    spreadsheet in any of the OUTPUT_LAYOUTS into a dict of MailMergeRows
+    keyed by lowercase full name.
+
+    The layout is detected from the header row. Raise ValueError if the
+    header doesn't match any layout, rather than lose anyone's shifts.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return {}
+    contact_headers = PersonSchedule.contact_headers()
+    num_contact_columns = len(contact_headers)
+    if header[:num_contact_columns] != contact_headers:
+        raise ValueError(
+            f"Header {header} doesn't start with the columns {contact_headers}"
+        )
+    shift_headers = header[num_contact_columns:]
+    if shift_headers[:2] == PersonSchedule.list_headers()[num_contact_columns:]:
+        additional_columns = header[len(PersonSchedule.list_headers()) :]
+        people = {}
+        for row in rows:
             person_row = parse_mailmerge_row(row, additional_columns)
             people[person_row.full_name.lower()] = person_row
+    elif shift_headers[: len(LONG_SHIFT_HEADERS)] == LONG_SHIFT_HEADERS:
+        people = _parse_long_rows(rows, header, num_contact_columns)
+    else:
+        people = _parse_wide_rows(rows, header, num_contact_columns)
+    for person_row in people.values():
+        # Files written before phones were normalized have bare 10-digit
+        # numbers; keep those in the same format as new rows. Anything else
+        # in the cell column may have been written by hand, so leave it be
+        phone = person_row.phone
+        if len(phone) == 10 and phone.isascii() and phone.isdigit():
+            person_row.phone = "+1" + phone
+    return people
+
+
+def _parse_long_rows(rows, header, num_contact_columns):
+    num_standard_columns = num_contact_columns + len(LONG_SHIFT_HEADERS)
+    additional_columns = header[num_standard_columns:]
+    people = {}
+    for row in rows:
+        key = row[0].lower()
+        if key not in people:
+            people[key] = MailMergeRow(
+                *row[:num_contact_columns],
+                [],
+                [],
+                dict(zip(additional_columns, row[num_standard_columns:])),
+            )
+        shift_fields = row[num_contact_columns:num_standard_columns]
+        shift_type, date, time, turf, hq = shift_fields
+        if shift_type == "walkthrough":
+            people[key].walkthrough_shifts.append(
+                (date, time, turf or None, hq or None)
+            )
+        elif shift_type == "phonebank":
+            people[key].phonebank_shifts.append((date, time))
+        elif shift_type:
+            raise ValueError(f"Invalid shift_type: {shift_type}")
+    return people
+
+
+def _parse_wide_rows(rows, header, num_contact_columns):
+    date_columns = {}
+    additional_columns = []
+    for column_index, column_header in enumerate(header):
+        if column_index < num_contact_columns:
+            continue
+        if column_header.startswith(WIDE_DATE_PREFIX):
+            date_columns[column_index] = column_header[len(WIDE_DATE_PREFIX) :]
+        else:
+            additional_columns.append((column_index, column_header))
+    people = {}
+    for row in rows:
+        if not date_columns:
+            # Only a wide table of nobody has no date columns
+            raise ValueError(
+                f"Header {header} doesn't match any of the layouts {OUTPUT_LAYOUTS}"
+            )
+        person_row = MailMergeRow(
+            *row[:num_contact_columns],
+            [],
+            [],
+            {name: row[index] for index, name in additional_columns},
+        )
+        for column_index, date in date_columns.items():
+            if not row[column_index]:
+                continue
+            for shift_str in row[column_index].split("\n"):
+                fields = shift_str.split(WIDE_FIELD_SEPARATOR)
+                if len(fields) > 4:
+                    raise ValueError(f"String '{shift_str}' has too many fields")
+                fields += [""] * (4 - len(fields))
+                shift_type, time, turf, hq = fields
+                if shift_type == "walkthrough":
+                    person_row.walkthrough_shifts.append(
+                        (date, time, turf or None, hq or None)
+                    )
+                elif shift_type == "phonebank":
+                    person_row.phonebank_shifts.append((date, time))
+                else:
+                    raise ValueError(f"Invalid shift_type: {shift_type}")
+        people[person_row.full_name.lower()] = person_row
     return people
 
 
 def parse_mailmerge_row(row, additional_columns):
     """Parse a row (list of strings) from the output-formatted spreadsheet into a
     MailMergeRow.
+
+    The shift columns are left unparsed; see MailMergeRow.process_shifts_list.
     """
+    num_contact_columns = len(PersonSchedule.contact_headers())
     num_standard_columns = len(PersonSchedule.list_headers())
+    raw_walkthrough_shifts, raw_phonebank_shifts = row[
+        num_contact_columns:num_standard_columns
+    ]
     additional_values = dict(zip(additional_columns, row[num_standard_columns:]))
-    person_row = MailMergeRow(*row[:num_standard_columns], additional_values)
-    person_row.process_shifts_list()
-    return person_row
+    return MailMergeRow(
+        *row[:num_contact_columns],
+        None,
+        None,
+        additional_values,
+        raw_walkthrough_shifts,
+        raw_phonebank_shifts,
+    )
 
 
-def daily_shifts_csv(date_str, existing_mailmerge_filename, output_filename):
-    existing_people = list(scan_mailmerge_csv(existing_mailmerge_filename).values())
-    specific_date_people = filter_daily_shifts(date_str, existing_people)
-    write_csv(output_filename, specific_date_people)
+def daily_shifts_csv(
+    date_str, existing_mailmerge_filename, output_filename, layout="mailmerge"
+):
+    with output_lock(existing_mailmerge_filename, output_filename):
+        existing_people = list(scan_mailmerge_csv(existing_mailmerge_filename).values())
+        specific_date_people = filter_daily_shifts(date_str, existing_people)
+        write_csv(output_filename, specific_date_people, layout)
 
 
 def filter_daily_shifts(date_str, people):
     existing_people = people
     specific_date_people = []
     for person in existing_people:
+        person.process_shifts_list()
         walkthroughs = [
             shift for shift in person.walkthrough_shifts if date_str in shift[0]
         ]
@@ -432,11 +1071,23 @@ def filter_daily_shifts(date_str, people):
     return specific_date_people
 
 
-def update_csv(grid_filename, existing_mailmerge_filename, output_filename, config):
-    new_version_people = load_grid_schedule_csv(grid_filename, config)
-    existing_people = scan_mailmerge_csv(existing_mailmerge_filename)
-    existing_people = update_with_new_shifts(existing_people, new_version_people)
-    write_csv(output_filename, list(existing_people.values()))
+def update_csv(
+    grid_filename,
+    existing_mailmerge_filename,
+    output_filename,
+    config,
+    rollup=None,
+    layout="mailmerge",
+):
+    new_version_people = load_grid_schedule_csv(grid_filename, config, rollup)
+    # Hold the lock from reading to writing, since the existing file is often
+    # the previous run's output
+    with output_lock(existing_mailmerge_filename, output_filename):
+        existing_people = scan_mailmerge_csv(existing_mailmerge_filename)
+        existing_people = list(
+            update_with_new_shifts(existing_people, new_version_people).values()
+        )
+        write_csv(output_filename, existing_people, layout)
 
 
 def update_with_new_shifts(existing_people, new_version_people):
@@ -455,6 +1106,7 @@ def update_with_new_shifts(existing_people, new_version_people):
                 new_version_person.first_name(),
                 new_version_person.last_name(),
                 new_version_person.phone,
+                new_version_person.email,
                 new_version_person.walkthrough_shifts,
                 new_version_person.phonebank_shifts,
                 {},
@@ -489,18 +1141,43 @@ Do not rearrange the first 7 columns of the output!
     parser.add_argument("outfile")
     parser.add_argument("--update")
     parser.add_argument("--daily")
+    parser.add_argument(
+        "--rollup",
+        metavar="ROLLUP_CSV",
+        help="Also write per-turf/HQ staffing counts for each time block to this file",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=OUTPUT_LAYOUTS,
+        default="mailmerge",
+        help="mailmerge: 1 row per person with all their shifts in 2 cells; "
+        "long: 1 row per shift; wide: 1 row per person with 1 column per date. "
+        "Any layout can be read back with --update or --daily",
+    )
+    parser.add_argument(
+        "--contact-stats",
+        action="store_true",
+        help="Print how many contact strings were parsed and how long it took",
+    )
     parser.add_argument("--config", default="config.json")
     args = parser.parse_args()
-    with open(args.config, "r") as configfile:
-        config = json.load(configfile)
-        for sub_dict in config:
-            for k, v in config[sub_dict].copy().items():
-                config[sub_dict][int(k)] = v
-                del config[sub_dict][k]
+    if args.rollup is not None and args.daily is not None:
+        parser.error("--rollup needs the signup grid, so it can't be used with --daily")
+    config = load_config(args.config)
+    rollup = None if args.rollup is None else StaffingRollup()
     if args.update is None and args.daily is None:
-        people = load_grid_schedule_csv(args.infile, config)
-        write_csv(args.outfile, people)
+        people = load_grid_schedule_csv(args.infile, config, rollup)
+        write_csv(args.outfile, people, args.layout)
     elif args.daily is None:
-        update_csv(args.infile, args.update, args.outfile, config)
+        update_csv(args.infile, args.update, args.outfile, config, rollup, args.layout)
     else:
-        daily_shifts_csv(args.daily, args.infile, args.outfile)
+        daily_shifts_csv(args.daily, args.infile, args.outfile, args.layout)
+    if rollup is not None:
+        write_rollup_csv(args.rollup, rollup)
+    if args.contact_stats:
+        stats = contact_scan_stats()
+        print(
+            f"Contact strings: {stats['lookups']} looked up, {stats['parses']} parsed "
+            f"in {stats['parse_seconds']:.4f}s",
+            file=sys.stderr,
+        )
@@ -26,80 +26,154 @@ def open_worksheet(location):
     return worksheet
 
 
-def scan_gsheet(in_location, config):
+def scan_gsheet(in_location, config, rollup=None):
     spreadsheet = open_spreadsheet(in_location.url)
     worksheet = spreadsheet.worksheet(in_location.tab)
     all_values = worksheet.get_all_values()
+    layout = sav_shifts.compile_layout(config)
     signups = []
     for row_index, row in enumerate(all_values):
-        new_signups = sav_shifts.parse_row(row, row_index, config)
+        new_signups = sav_shifts.parse_row(row, row_index, layout, rollup)
         if new_signups is not None:
             signups.extend(new_signups)
     return signups
 
 
-def load_grid_schedule(in_location, config):
-    signups = scan_gsheet(in_location, config)
+def load_grid_schedule(in_location, config, rollup=None):
+    signups = scan_gsheet(in_location, config, rollup)
     people = sav_shifts.aggregate_signups(signups)
     return sorted(people)
 
 
-def write_schedule(out_location, people):
+def write_schedule(out_location, people, layout="mailmerge"):
+    write_table(
+        out_location,
+        sav_shifts.table_headers(people, layout),
+        sav_shifts.table_rows(people, layout),
+    )
+
+
+def write_rollup(out_location, rollup, before_tab=None):
+    write_table(out_location, rollup.list_headers(), rollup.to_lists(), before_tab)
+
+
+# Google recommends keeping each request body under about 2 MB
+MAX_REQUEST_BYTES = 2_000_000
+
+
+def write_table(out_location, headers, rows, before_tab=None):
+    """Write headers and rows to the out_location tab, replacing whatever was
+    there.
+
+    A new tab is added as the rightmost tab, or just left of before_tab if
+    given, so it doesn't become the tab that --update and --daily read by
+    default.
+
+    The tab is created (or resized and cleared) at exactly the size of the
+    table with the header row frozen, all in one spreadsheets.batchUpdate.
+    The values then go out in as few values.batchUpdate requests as fit
+    under MAX_REQUEST_BYTES.
+    """
     spreadsheet = open_spreadsheet(out_location.url)
-    if out_location.tab in [ws.title for ws in spreadsheet.worksheets()]:
-        worksheet = spreadsheet.worksheet(out_location.tab)
-        if worksheet.frozen_row_count == 0:
-            worksheet.freeze(rows=1)
+    values = [headers] + rows
+    grid_properties = {
+        # Sheets won't let every row of a tab be frozen
+        "rowCount": max(len(values), 2),
+        "columnCount": max(len(row) for row in values),
+        "frozenRowCount": 1,
+    }
+    worksheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+    if out_location.tab in worksheets:
+        sheet_id = worksheets[out_location.tab].id
+        requests = [
+            {
+                "updateSheetProperties": {
+                    "properties": {
+                        "sheetId": sheet_id,
+                        "gridProperties": grid_properties,
+                    },
+                    "fields": "gridProperties(rowCount,columnCount,frozenRowCount)",
+                }
+            },
+            {
+                "updateCells": {
+                    "range": {"sheetId": sheet_id},
+                    "fields": "userEnteredValue",
+                }
+            },
+        ]
     else:
-        worksheet = spreadsheet.add_worksheet(out_location.tab, rows=1000, cols=26)
-        worksheet.freeze(rows=1)
-    first_person = people[0]
-    headers = first_person.list_headers()
-    update = []
-    update.append(
-        {
-            "range": "A1:Z1",
-            "values": [headers],
-        }
-    )
-    update.append(
-        {
-            "range": "A2:Z",
-            "values": [person.to_list() for person in people],
+        properties = {
+            "title": out_location.tab,
+            "gridProperties": grid_properties,
         }
+        if before_tab is not None:
+            properties["index"] = worksheets[before_tab].index
+        requests = [{"addSheet": {"properties": properties}}]
+    spreadsheet.batch_update({"requests": requests})
+    for data in chunk_values(out_location.tab, values, MAX_REQUEST_BYTES):
+        spreadsheet.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+
+
+def chunk_values(tab, values, max_bytes=MAX_REQUEST_BYTES):
+    """Split values into lists of values.batchUpdate ranges, each making a
+    request body of at most max_bytes of JSON.
+
+    A single row bigger than max_bytes still gets a chunk of its own.
+    """
+    # The request body around the rows, with the longest range name any
+    # chunk can have; rows are then joined by ", " as json.dumps does
+    wrapper_bytes = len(
+        json.dumps(
+            {"valueInputOption": "RAW", "data": [_value_range(tab, len(values), [])]}
+        )
     )
-    worksheet.clear()
-    worksheet.batch_update(update)
+    chunk_start = 0
+    chunk_bytes = wrapper_bytes
+    for row_index, row in enumerate(values):
+        row_bytes = len(json.dumps(row)) + len(", ")
+        if chunk_bytes + row_bytes > max_bytes and row_index > chunk_start:
+            yield [_value_range(tab, chunk_start, values[chunk_start:row_index])]
+            chunk_start = row_index
+            chunk_bytes = wrapper_bytes
+        chunk_bytes += row_bytes
+    yield [_value_range(tab, chunk_start, values[chunk_start:])]
+
+
+def _value_range(tab, row_index, values):
+    top_left = gspread.utils.rowcol_to_a1(row_index + 1, 1)
+    return {
+        "range": gspread.utils.absolute_range_name(tab, top_left),
+        "values": values,
+    }
 
 
 def scan_mailmerge_sheet(location):
     spreadsheet = open_spreadsheet(location.url)
     worksheet = spreadsheet.worksheet(location.tab)
-    num_standard_columns = len(sav_shifts.PersonSchedule.list_headers())
-    people = {}
-    for i, row in enumerate(worksheet.get_values()):
-        if i == 0:
-            header = row
-            additional_columns = row[num_standard_columns:]
-            continue
-        person_row = sav_shifts.parse_mailmerge_row(row, additional_columns)
-        people[person_row.full_name.lower()] = person_row
-    return people
-
-
-def update_schedule(existing_location, update_location, out_location, config):
+    return sav_shifts.parse_mailmerge_table(worksheet.get_values())
+
+
+def update_schedule(
+    existing_location,
+    update_location,
+    out_location,
+    config,
+    rollup=None,
+    layout="mailmerge",
+):
     """Update the records from existing_location with the current signup sheet
     at update_location and put the result in out_location.
     """
     existing_people = scan_mailmerge_sheet(existing_location)
-    new_version_people = load_grid_schedule(update_location, config)
+    new_version_people = load_grid_schedule(update_location, config, rollup)
     updated_people = sav_shifts.update_with_new_shifts(
         existing_people, new_version_people
     )
-    write_schedule(out_location, list(updated_people.values()))
+    write_schedule(out_location, list(updated_people.values()), layout)
 
 
-def daily_shifts(date_str, in_location, out_location):
+def daily_shifts(date_str, in_location, out_location, layout="mailmerge"):
     if out_location.tab is None:
         now = datetime.now()
         new_tab_name = now.strftime(f"Shifts for {date_str} as of %m/%d %I:%M%p")
@@ -110,10 +184,12 @@ def daily_shifts(date_str, in_location, out_location):
         in_location.tab = worksheets[-1].title
     existing_people = list(scan_mailmerge_sheet(in_location).values())
     specific_date_people = sav_shifts.filter_daily_shifts(date_str, existing_people)
-    write_schedule(out_location, specific_date_people)
+    write_schedule(out_location, specific_date_people, layout)
 
 
-def process_calendar(config, in_location, out_location, update):
+def process_calendar(
+    config, in_location, out_location, update, rollup=False, layout="mailmerge"
+):
     """Convert from signup calendar spreadsheet to new mail merge spreadsheet.
 
     If out_location.tab is None, compute a new tab name based on the current time.
@@ -122,20 +198,35 @@ def process_calendar(config, in_location, out_location, update):
     If update is None, update from the rightmost tab in out_location.url.
     If update is a string, update from the tab in out_location.url with that name,
     or error out if the tab doesn't exist.
+
+    If rollup is True, also write the per-turf/HQ staffing counts to a
+    "Staffing as of ..." tab just left of the new shifts tab, computed while
+    the signups are scanned.
+
+    layout is one of sav_shifts.OUTPUT_LAYOUTS.
     """
     now = datetime.now()
     new_tab_name = now.strftime("Shifts as of %m/%d %I:%M%p")
     out_location.tab = new_tab_name
+    staffing = sav_shifts.StaffingRollup() if rollup else None
     if update is False:
-        people = load_grid_schedule(in_location, config)
-        write_schedule(out_location, people)
-        return
-    if update is None:
-        out_sheet = open_spreadsheet(out_location.url)
-        worksheets = out_sheet.worksheets()
-        update = worksheets[-1].title
-    existing_location = SpreadsheetLocation(out_location.url, update)
-    update_schedule(existing_location, in_location, out_location, config)
+        people = load_grid_schedule(in_location, config, staffing)
+        write_schedule(out_location, people, layout)
+    else:
+        if update is None:
+            out_sheet = open_spreadsheet(out_location.url)
+            worksheets = out_sheet.worksheets()
+            update = worksheets[-1].title
+        existing_location = SpreadsheetLocation(out_location.url, update)
+        update_schedule(
+            existing_location, in_location, out_location, config, staffing, layout
+        )
+    if staffing is not None:
+        rollup_location = SpreadsheetLocation(
+            out_location.url, now.strftime("Staffing as of %m/%d %I:%M%p")
+        )
+        # Left of the shifts tab, so the shifts tab stays the rightmost
+        write_rollup(rollup_location, staffing, out_location.tab)
 
 
 def parse_setup(url):
@@ -181,20 +272,36 @@ The config file should describe the layout of the signups calendar spreadsheet."
         help="Carry over custom fields from rightmost tab, "
         "or provide a specific tab name to use",
     )  # If flag not present, will be False; if flag present with no value, will be None
+    parser.add_argument(
+        "--rollup",
+        action="store_true",
+        help="Also write a tab with signups, empty organizer slots and "
+        "unassigned turfs for each time block, turf and HQ",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=sav_shifts.OUTPUT_LAYOUTS,
+        default="mailmerge",
+        help="mailmerge: 1 row per person with all their shifts in 2 cells; "
+        "long: 1 row per shift; wide: 1 row per person with 1 column per date. "
+        "Tabs in any layout can be read back with --update or --daily",
+    )
     parser.add_argument("--config", default="config.json", metavar="JSON_FILE")
     args = parser.parse_args()
-    with open(args.config, "r") as configfile:
-        config = json.load(configfile)
-        for sub_dict in config:
-            for k, v in config[sub_dict].copy().items():
-                config[sub_dict][int(k)] = v
-                del config[sub_dict][k]
+    if args.rollup and args.daily is not None:
+        parser.error("--rollup needs the signup grid, so it can't be used with --daily")
+    config = sav_shifts.load_config(args.config)
     signups_location = parse_setup(args.url)
     if args.daily is None:
         process_calendar(
-            config, signups_location, SpreadsheetLocation(args.url, None), args.update
+            config,
+            signups_location,
+            SpreadsheetLocation(args.url, None),
+            args.update,
+            args.rollup,
+            args.layout,
         )
     else:
         in_location = SpreadsheetLocation(args.url, None)
         out_location = SpreadsheetLocation(args.url, None)
-        daily_shifts(args.daily, in_location, out_location)
+        daily_shifts(args.daily, in_location, out_location, args.layout)